@@ -62,7 +62,8 @@ def build_generator(x, nb_rows, nb_cols, last_activation = 'none'):
     return x
 
 
-def build_discriminator(image, mbd=False, sparsity=False, sparsity_mbd=False):
+def build_discriminator(image, mbd=False, sparsity=False, sparsity_mbd=False,
+                        shared_stem=None):
     """ Generator sub-component for the CaloGAN
 
     Args:
@@ -72,6 +73,8 @@ def build_discriminator(image, mbd=False, sparsity=False, sparsity_mbd=False):
         sparsiry: bool, whether or not to calculate and include sparsity
         sparsity_mdb: bool, perform minibatch discrimination on the sparsity 
             values in a batch
+        shared_stem: a keras Conv2D layer to use as the first convolution, so
+            that it can be shared across calo layers (a new one if None)
 
     Returns:
     --------
@@ -79,7 +82,9 @@ def build_discriminator(image, mbd=False, sparsity=False, sparsity_mbd=False):
 
     """
 
-    x = Conv2D(64, (2, 2), padding='same')(image)
+    if shared_stem is None:
+        shared_stem = Conv2D(64, (2, 2), padding='same')
+    x = shared_stem(image)
     x = LeakyReLU()(x)
 
     x = ZeroPadding2D((1, 1))(x)
@@ -96,6 +96,31 @@ def calculate_energy(x):
     return Lambda(single_layer_energy, single_layer_energy_output_shape)(x)
 
 
+def layer_energies(x):
+    """ Computes the energy of each calo layer in a list as one (None, n) tensor"""
+    return K.concatenate([single_layer_energy(l) for l in x], axis=-1)
+
+
+def layer_energies_output_shape(input_shape):
+    return (input_shape[0][0], len(input_shape))
+
+
+def energy_features(x):
+    """ Computes the scaled per-layer and total energies, the absolute
+    deviation from the requested energy and whether it is over 5 GeV, as one
+    (None, n + 3) tensor from [energies, total_energy, input_energy]"""
+    energies, total_energy, input_energy = x
+    energy_well = K.abs(total_energy - input_energy)
+    well_too_big = 10 * K.cast(energy_well > 5, K.floatx())
+    return K.concatenate(
+        [energies / 10, total_energy / 100, energy_well, well_too_big], axis=-1)
+
+
+def energy_features_output_shape(input_shape):
+    shape = list(input_shape[0])
+    return (shape[0], shape[1] + 3)
+
+
 def threshold_indicator(x, thresh):
     return K.cast(x > thresh, K.floatx())
 
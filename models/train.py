@@ -17,13 +17,17 @@ import logging
 import numpy as np
 import os
 import glob
+import re
 from six.moves import range
 from sklearn.preprocessing import LabelEncoder
-from sklearn.utils import shuffle
 import sys
 import yaml
 import pickle
-import time
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 if __name__ == '__main__':
@@ -36,13 +40,90 @@ if __name__ == '__main__':
 else:
     logger = logging.getLogger(__name__)
 
-
-def bit_flip(x, prob=0.05):
-    """ flips a int array's values with some probability """
-    x = np.array(x)
-    selection = np.random.uniform(0, 1, x.shape) < prob
-    x[selection] = 1 * np.logical_not(x[selection])
-    return x
+# shared PCG64 generator for all host-side sampling (noise, energies, labels)
+rng = np.random.default_rng()
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _bit_flip_nb(x, rand, prob, out):
+        for i in range(x.size):
+            out[i] = x[i] ^ 1 if rand[i] < prob else x[i]
+
+
+def bit_flip(x, prob=0.05, out=None, rand=None):
+    """ flips a binary int array's values with some probability
+
+    Pass `out` and `rand` to write the result and the uniform draws into
+    preallocated arrays instead of new ones. Runs as a single compiled loop
+    if numba is installed, and as one XOR against a boolean mask otherwise.
+    """
+    x = np.ascontiguousarray(x)
+    if out is None:
+        out = np.empty_like(x)
+    rand = rng.random(x.shape, dtype=np.float32, out=rand)
+    if njit is None:
+        return np.bitwise_xor(x, rand < prob, out=out)
+    _bit_flip_nb(x.ravel(), rand.ravel(), prob, out.ravel())
+    return out
+
+
+def _read_keras_hdf5_weights(filename):
+    """ reads a file written by Model.save_weights into a list of numpy
+    arrays, in the order Model.get_weights() returns them, without going
+    through the model's variables """
+
+    import h5py
+
+    def _names(attrs, key):
+        return [n.decode('utf8') if hasattr(n, 'decode') else n
+                for n in attrs[key]]
+
+    weights = []
+    with h5py.File(filename, 'r') as f:
+        # files written by Model.save keep the weights in a subgroup
+        g = f['model_weights'] if 'layer_names' not in f.attrs else f
+        for layer_name in _names(g.attrs, 'layer_names'):
+            layer = g[layer_name]
+            weights.extend(layer[w][()] for w in _names(layer.attrs, 'weight_names'))
+    return weights
+
+
+def _save_optimizer_weights(filename, weights):
+    """ saves optimizer weights as one flat float32 array (the iteration
+    count included, which is exact up to 2**24 steps), so that
+    _load_optimizer_weights can memory-map it; np.save of the list itself
+    writes a pickled object array, as the weights differ in shape """
+    flat = np.lib.format.open_memmap(
+        filename, mode='w+', dtype=np.float32,
+        shape=(sum(np.size(w) for w in weights), ))
+    offset = 0
+    for w in weights:
+        flat[offset:offset + np.size(w)] = np.ravel(w)
+        offset += np.size(w)
+    flat.flush()
+
+
+def _load_optimizer_weights(filename, shapes):
+    """ loads optimizer weights written by _save_optimizer_weights as views
+    of the given shapes into the memory-mapped file, so that pages are only
+    read in while they are copied to the GPU. Files written by np.save of the
+    weight list are still read, in full """
+    try:
+        flat = np.load(filename, mmap_mode='r')
+    except ValueError:
+        # a pickled object array, which can't be memory-mapped
+        return np.load(filename, allow_pickle=True)
+    weights = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        weights.append(flat[offset:offset + size].reshape(shape))
+        offset += size
+    if offset != flat.size:
+        raise ValueError('{} holds {} optimizer values, expected {}'.format(
+            filename, flat.size, offset))
+    return weights
 
 
 def get_parser():
@@ -121,6 +202,15 @@ def get_parser():
     parser.add_argument('--train-gen-per-epoch', action='store', type=int, default=1,
                          help='Train the generator n times per epoch')
 
+    parser.add_argument('--mixed-precision', action='store_true',
+                         default=False, help='Run convolutions and matrix multiplications in float16 (TensorFlow auto mixed precision graph rewrite), with dynamic loss scaling')
+
+    parser.add_argument('--loss-scale', action='store', type=float, default=1024.0,
+                         help='Initial loss scale for --mixed-precision, to keep small float16 gradients from underflowing. Steps whose gradients overflow are skipped and halve the scale, 2000 good steps in a row double it; a scale far too large costs a run of skipped steps at the start, and the scale restarts from this value on resume')
+
+    parser.add_argument('--share-disc-stem', action='store_true',
+                         default=False, help='Share the first discriminator convolution across the three calorimeter layers')
+
     parser.add_argument('dataset', action='store', type=str,
                         help='yaml file with particles and HDF5 paths (see '
                         'github.com/hep-lbdl/CaloGAN/blob/master/models/'
@@ -135,14 +225,29 @@ if __name__ == '__main__':
     parse_args = parser.parse_args()
 
     # delay the imports so running train.py -h doesn't take 5,234,807 years
+    # EV 10-Jan-2021 Import Horovod
+    import horovod.keras as hvd
+
+    # EV 10-Jan-2021: initialize Horovod
+    hvd.init()
+
+    # Horovod: pin GPU to be used to process local rank (one GPU per process).
+    # This has to happen before CUDA is initialized, i.e. before the first
+    # session is created; if the scheduler already restricted the visible
+    # devices, pick ours among those
+    visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible_devices:
+        visible_devices = visible_devices.split(',')
+        os.environ['CUDA_VISIBLE_DEVICES'] = visible_devices[hvd.local_rank() % len(visible_devices)]
+    else:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(hvd.local_rank())
+
     # from tf.compat.v1.keras import backend as K # TensofFlow 2.X
     import keras.backend as K # TensorFlow 1.X
     #import tensorflow.keras.backend as K
-    # EV 10-Jan-2021 Import Horovod
-    import horovod.keras as hvd
     import tensorflow as tf
-    from keras.layers import (Activation, AveragePooling2D, Dense, Embedding,
-                              Flatten, Input, Lambda, UpSampling2D)
+    from keras.layers import (Activation, AveragePooling2D, Conv2D, Dense,
+                              Embedding, Flatten, Input, Lambda, UpSampling2D)
     from keras.layers.merge import add, concatenate, multiply
     from keras.models import Model
     from keras.optimizers import Adam
@@ -150,22 +255,26 @@ if __name__ == '__main__':
     from keras.callbacks import CallbackList
     from keras import models
 
-    # EV 10-Jan-2021: initialize Horovod
-    hvd.init()
-
-    # EV 10-Jan-2021: Horovod: pin GPU to be used to process local rank (one GPU per process)
     try: 
         config = tf.ConfigProto() # TensorFlow 1.X
     except:
         config = tf.compat.v1.ConfigProto() # TensorFlow 2.X
     config.gpu_options.allow_growth = True
-    config.gpu_options.visible_device_list = str(hvd.local_rank())
+    if parse_args.mixed_precision:
+        # grappler casts the GEMM/conv-heavy parts of the graph to float16,
+        # while variables, reductions (e.g. the layer energy sums) and losses
+        # stay in float32; the gradients are loss-scaled (see LossScaledAdam)
+        from tensorflow.core.protobuf import rewriter_config_pb2
+        config.graph_options.rewrite_options.auto_mixed_precision = \
+            rewriter_config_pb2.RewriterConfig.ON
     K.set_session(tf.Session(config=config))
 
     K.common.set_image_dim_ordering('tf')
 
     from models.ops import (minibatch_discriminator, minibatch_output_shape, Dense3D,
-                     calculate_energy, scale, inpainting_attention)
+                     layer_energies, layer_energies_output_shape,
+                     energy_features, energy_features_output_shape,
+                     scale, inpainting_attention)
 
     from models.architectures import build_generator, build_discriminator
 
@@ -201,12 +310,15 @@ if __name__ == '__main__':
     train_gen_per_epoch = parse_args.train_gen_per_epoch
     save_all_epochs = parse_args.save_all_epochs
     weights_averaging_coeff = parse_args.weights_averaging_coeff
+    mixed_precision = parse_args.mixed_precision
+    loss_scale = parse_args.loss_scale
+    share_disc_stem = parse_args.share_disc_stem
 
     # EV 10-Jan-2021 Adjust the learning rate
-    #disc_lr = parse_args.disc_lr
-    #gen_lr = parse_args.gen_lr
-    disc_lr = parse_args.disc_lr * 1
-    gen_lr = parse_args.gen_lr * 1
+    # scale by the number of workers; the first epochs ramp up to these values
+    # from the single-worker ones (see LearningRateWarmupCallback below)
+    disc_lr = parse_args.disc_lr * hvd.size()
+    gen_lr = parse_args.gen_lr * hvd.size()
 
     adam_beta_1 = parse_args.adam_beta
 
@@ -230,6 +342,8 @@ if __name__ == '__main__':
     logger.debug('discriminator learning rate = {}'.format(disc_lr))
     logger.debug('generator learning rate = {}'.format(gen_lr))
     logger.debug('Adam $\beta_1$ parameter = {}'.format(adam_beta_1))
+    logger.debug('mixed precision = {}'.format(mixed_precision))
+    logger.debug('loss scale = {}'.format(loss_scale))
     logger.debug('Will read YAML spec from {}'.format(yaml_file))
 
     # read in data file spec from YAML file
@@ -248,87 +362,247 @@ if __name__ == '__main__':
         for name, pth in s.items():
             logger.debug('class {} <= {}'.format(name, pth))
 
-    def _load_data(particle, datafile):
+    def _read_shapes(datafile):
 
         import h5py
 
-        d = h5py.File(datafile, 'r')
+        with h5py.File(datafile, 'r') as d:
+            return [d['layer_{}'.format(l)].shape for l in range(3)]
 
-        # make our calo images channels-last
-        first = np.expand_dims(d['layer_0'][:], -1)
-        second = np.expand_dims(d['layer_1'][:], -1)
-        third = np.expand_dims(d['layer_2'][:], -1)
-        # convert to MeV
-        energy = d['energy'][:].reshape(-1, 1) * 1000
+    def _load_data(particles, dtype=np.float32, rank=0, world=1):
+        """ reads this rank's shard (every world-th event, starting at rank) of
+        every (particle, datafile) pair straight into preallocated, already
+        concatenated arrays, one file per worker thread. The calo images are
+        stored as `dtype`, the energies always as float32 """
 
-        sizes = [
-            first.shape[1], first.shape[2],
-            second.shape[1], second.shape[2],
-            third.shape[1], third.shape[2]
-        ]
-
-        y = [particle] * first.shape[0]
-
-        d.close()
+        import h5py
+        from concurrent.futures import ThreadPoolExecutor
+
+        # first pass: only read the shapes, to size the output arrays
+        shapes = [_read_shapes(f) for _, f in particles]
+        for (_, datafile), shape in zip(particles, shapes):
+            if [sh[1:] for sh in shape] != [sh[1:] for sh in shapes[0]]:
+                raise ValueError('Calorimeter layer shapes in {} do not match '
+                                 'those in {}'.format(datafile, particles[0][1]))
+
+        # the same number of events from each file on every rank, so that all
+        # ranks run the same number of batches
+        counts = [shape[0][0] // world for shape in shapes]
+        offsets = np.cumsum([0] + counts[:-1])
+        nb_events = sum(counts)
+
+        layers = [np.empty((nb_events, ) + sh[1:], dtype=dtype)
+                  for sh in shapes[0]]
+        energy = np.empty((nb_events, 1), dtype=np.float32)
+
+        def _read(job):
+            datafile, offset, n = job
+            if n == 0:
+                return
+            src = np.s_[rank:rank + n * world:world]
+            dest = np.s_[offset:offset + n]
+            with h5py.File(datafile, 'r') as d:
+                for l, X in enumerate(layers):
+                    ds = d['layer_{}'.format(l)]
+                    if X.dtype == np.float32:
+                        ds.read_direct(X, source_sel=src, dest_sel=dest)
+                        # scale the energy depositions by 1000 to convert MeV => GeV
+                        np.multiply(X[dest], 1e-3, out=X[dest])
+                    else:
+                        # raw MeV values can overflow float16, so scale blocks
+                        # at the stored precision and only downcast the result
+                        for start in range(0, n, 10000):
+                            stop = min(start + 10000, n)
+                            np.multiply(
+                                ds[rank + start * world:rank + stop * world:world],
+                                1e-3, out=X[offset + start:offset + stop])
+                # energy may be stored as (N, ) or (N, 1)
+                d['energy'].read_direct(
+                    energy.reshape((nb_events, ) + d['energy'].shape[1:]),
+                    source_sel=src, dest_sel=dest
+                )
+
+        jobs = zip([f for _, f in particles], offsets, counts)
+        with ThreadPoolExecutor(max_workers=len(particles)) as ex:
+            # consume the results so that worker exceptions are raised here
+            list(ex.map(_read, jobs))
+
+        # make our calo images channels-last (a view, not a copy)
+        first, second, third = [X[..., np.newaxis] for X in layers]
+
+        sizes = [dim for sh in shapes[0] for dim in sh[1:]]
+
+        y = np.repeat([p for p, _ in particles], counts)
 
         return first, second, third, y, energy, sizes
 
     logger.debug('loading data from {} files'.format(nb_classes))
 
-    if sys.version_info[0] < 3: # Python 2.X
-        first, second, third, y, energy, sizes = [
-            np.concatenate(t) for t in [
-                a for a in zip(*[_load_data(p, f) for p, f in s.iteritems()])
-            ]
-        ]
-    else: # Python 3.X
-        first, second, third, y, energy, sizes = [
-            np.concatenate(t) for t in [
-                a for a in zip(*[_load_data(p, f) for p, f in s.items()])
-            ]
-        ]
-
-    # TO-DO: check that all sizes match, so I could be taking any of them
-    sizes = sizes[:6].tolist()
-
-    # scale the energy depositions by 1000 to convert MeV => GeV
-    first, second, third, energy = [
-        (X.astype(np.float32) / 1000)
-        for X in [first, second, third, energy]
-    ]
-
-    le = LabelEncoder()
-    y = le.fit_transform(y)
-
-    first, second, third, y, energy = shuffle(first, second, third, y, energy,
-                                              random_state=0)
+    # under mixed precision, keep the showers in float16 on the host: half the
+    # memory and half the bytes copied to the GPU per real batch. The
+    # generated showers come out of the generator as float32, so the fake
+    # discriminator step pays a host-side cast to float16 every batch, and
+    # all of the discriminator's inputs, fakes included, are float16-quantized
+    # (see the upcast below)
+    image_dtype = np.float16 if mixed_precision else np.float32
+
+    # each rank only holds (and reads) its own shard of the events
+    first, second, third, y, energy, sizes = _load_data(list(s.items()),
+                                                        dtype=image_dtype,
+                                                        rank=hvd.rank(),
+                                                        world=hvd.size())
+
+    # fit on the class names rather than the shard, in case a small file
+    # leaves a class out of some rank's shard
+    le = LabelEncoder().fit(list(s.keys()))
+    # labels are only ever fed as targets, i.e. to float32 placeholders, so
+    # cast them once here instead of converting every batch before the copy
+    y = le.transform(y).astype(np.float32)
+
+    class LossScaledAdam(Adam):
+        """ Adam with dynamic loss scaling: the gradients are taken of
+        loss * loss_scale, so that small float16 gradients do not underflow
+        in the backward pass, and divided by loss_scale again before the
+        update. A step whose gradients are not all finite is skipped and
+        halves the scale; growth_interval finite steps in a row double it.
+        hvd.DistributedOptimizer wraps get_gradients, so the allreduced
+        gradients are the unscaled ones, and all ranks skip the same steps """
+
+        def __init__(self, loss_scale=1024.0, growth_interval=2000, **kwargs):
+            super(LossScaledAdam, self).__init__(**kwargs)
+            self.initial_loss_scale = loss_scale
+            self.growth_interval = growth_interval
+            with K.name_scope(self.__class__.__name__):
+                self.loss_scale = K.variable(loss_scale, name='loss_scale')
+                self.good_steps = K.variable(0, dtype='int64',
+                                             name='good_steps')
+
+        def get_gradients(self, loss, params):
+            grads = super(LossScaledAdam, self).get_gradients(
+                loss * self.loss_scale, params)
+            # the label Embedding goes through K.gather, so its gradient is
+            # an IndexedSlices, which has no division
+            return [tf.IndexedSlices(g.values / self.loss_scale, g.indices,
+                                     g.dense_shape)
+                    if isinstance(g, tf.IndexedSlices)
+                    else g / self.loss_scale
+                    for g in grads]
+
+        def get_updates(self, loss, params):
+            # Adam.get_updates, with every update gated on the gradients
+            # being finite, so that an overflow never reaches the weights or
+            # the moments
+            grads = self.get_gradients(loss, params)
+            finite = tf.reduce_all([
+                tf.reduce_all(tf.is_finite(
+                    g.values if isinstance(g, tf.IndexedSlices) else g))
+                for g in grads
+            ])
+
+            def gated_update(x, new_x):
+                return K.update(x, K.switch(finite, new_x, x))
+
+            self.updates = [K.update_add(
+                self.iterations, K.cast(finite, K.dtype(self.iterations)))]
+
+            lr = self.lr
+            if self.initial_decay > 0:
+                lr = lr * (1. / (1. + self.decay * K.cast(self.iterations,
+                                                          K.dtype(self.decay))))
+
+            t = K.cast(self.iterations, K.floatx()) + 1
+            lr_t = lr * (K.sqrt(1. - K.pow(self.beta_2, t)) /
+                         (1. - K.pow(self.beta_1, t)))
+
+            ms = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+            vs = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+            if self.amsgrad:
+                vhats = [K.zeros(K.int_shape(p), dtype=K.dtype(p))
+                         for p in params]
+            else:
+                vhats = [K.zeros(1) for _ in params]
+            # the same layout as Adam's, so the saved optimizer states do not
+            # depend on --mixed-precision; the loss scale is not saved, and
+            # starts over from --loss-scale on resume
+            self.weights = [self.iterations] + ms + vs + vhats
+
+            for p, g, m, v, vhat in zip(params, grads, ms, vs, vhats):
+                m_t = (self.beta_1 * m) + (1. - self.beta_1) * g
+                v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g)
+                if self.amsgrad:
+                    vhat_t = K.maximum(vhat, v_t)
+                    p_t = p - lr_t * m_t / (K.sqrt(vhat_t) + self.epsilon)
+                    self.updates.append(gated_update(vhat, vhat_t))
+                else:
+                    p_t = p - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
+
+                self.updates.append(gated_update(m, m_t))
+                self.updates.append(gated_update(v, v_t))
+                if getattr(p, 'constraint', None) is not None:
+                    p_t = p.constraint(p_t)
+                self.updates.append(gated_update(p, p_t))
+
+            # back off on overflow, grow after growth_interval good steps
+            grow = K.greater_equal(self.good_steps + 1, self.growth_interval)
+            self.updates.append(K.update(self.loss_scale, K.switch(
+                finite,
+                K.switch(grow, self.loss_scale * 2., self.loss_scale),
+                K.maximum(self.loss_scale / 2., 1.))))
+            self.updates.append(K.update(self.good_steps, K.switch(
+                tf.logical_and(finite, tf.logical_not(grow)),
+                self.good_steps + 1, K.zeros_like(self.good_steps))))
+            return self.updates
+
+        def get_config(self):
+            # hvd.DistributedOptimizer rebuilds the optimizer from its config
+            config = super(LossScaledAdam, self).get_config()
+            config['loss_scale'] = self.initial_loss_scale
+            config['growth_interval'] = self.growth_interval
+            return config
+
+    def make_adam(lr):
+        if mixed_precision:
+            return LossScaledAdam(lr=lr, beta_1=adam_beta_1, loss_scale=loss_scale)
+        return Adam(lr=lr, beta_1=adam_beta_1)
 
     logger.info('Building discriminator')
 
-    calorimeter = [Input(shape=sizes[:2] + [1]),
-                   Input(shape=sizes[2:4] + [1]),
-                   Input(shape=sizes[4:] + [1])]
+    calorimeter = [Input(shape=sizes[:2] + [1], dtype=np.dtype(image_dtype).name),
+                   Input(shape=sizes[2:4] + [1], dtype=np.dtype(image_dtype).name),
+                   Input(shape=sizes[4:] + [1], dtype=np.dtype(image_dtype).name)]
+
+    # float16 showers are only upcast once they are on the device. Rounding
+    # through float16 first is a no-op for the fed showers, but quantizes the
+    # float32 fakes the combined model passes in, so that D sees real and
+    # fake showers at the same precision on every path
+    if mixed_precision:
+        images = [Lambda(lambda x: K.cast(K.cast(x, 'float16'), K.floatx()))(c)
+                  for c in calorimeter]
+    else:
+        images = calorimeter
 
     input_energy = Input(shape=(1, ))
 
     features = []
-    energies = []
+
+    # the kernel of the first convolution does not depend on the image size,
+    # so one can serve all three calo layers
+    shared_stem = Conv2D(64, (2, 2), padding='same') if share_disc_stem else None
 
     for l in range(3):
         # build features per layer of calorimeter
         features.append(build_discriminator(
-            image=calorimeter[l],
+            image=images[l],
             mbd=True,
             sparsity=True,
-            sparsity_mbd=True
+            sparsity_mbd=True,
+            shared_stem=shared_stem
         ))
 
-        energies.append(calculate_energy(calorimeter[l]))
-
     features = concatenate(features)
 
     # This is a (None, 3) tensor with the individual energy per layer
-    energies = concatenate(energies)
+    energies = Lambda(layer_energies, layer_energies_output_shape)(images)
 
     # calculate the total energy across all rows
     total_energy = Lambda(
@@ -346,22 +620,16 @@ if __name__ == '__main__':
     # constrain w/ a tanh to dampen the unbounded nature of energy-space
     mbd_energy = Activation('tanh')(minibatch_featurizer(K_energy))
 
-    # absolute deviation away from input energy. Technically we can learn
+    # scaled energies, plus the absolute deviation away from input energy and
+    # a binary y/n if it is over the input energy. Technically we can learn
     # this, but since we want to get as close as possible to conservation of
     # energy, just coding it in is better
-    energy_well = Lambda(
-        lambda x: K.abs(x[0] - x[1])
-    )([total_energy, input_energy])
-
-    # binary y/n if it is over the input energy
-    well_too_big = Lambda(lambda x: 10 * K.cast(x > 5, K.floatx()))(energy_well)
+    energy_feats = Lambda(energy_features, energy_features_output_shape)(
+        [energies, total_energy, input_energy])
 
     p = concatenate([
         features,
-        scale(energies, 10),
-        scale(total_energy, 100),
-        energy_well,
-        well_too_big,
+        energy_feats,
         mbd_energy
     ])
 
@@ -387,7 +655,8 @@ if __name__ == '__main__':
     discriminator.compile(
         # EV 10-Jan-2021: add Horovod Distributed Optimizer
         #optimizer=Adam(lr=disc_lr, beta_1=adam_beta_1),
-        optimizer=hvd.DistributedOptimizer(Adam(lr=disc_lr, beta_1=adam_beta_1)),
+        optimizer=hvd.DistributedOptimizer(make_adam(disc_lr),
+                                           compression=hvd.Compression.fp16),
         loss=discriminator_losses
     )
 
@@ -450,7 +719,8 @@ if __name__ == '__main__':
     generator.compile(
         # EV 10-Jan-2021: add Horovod Distributed Optimizer
         #optimizer=Adam(lr=gen_lr, beta_1=adam_beta_1),
-        optimizer=hvd.DistributedOptimizer(Adam(lr=gen_lr, beta_1=adam_beta_1)),
+        optimizer=hvd.DistributedOptimizer(make_adam(gen_lr),
+                                           compression=hvd.Compression.fp16),
         loss='binary_crossentropy'
     )
 
@@ -463,20 +733,74 @@ if __name__ == '__main__':
     combined.compile(
         # EV 10-Jan-2021: add Horovod Distributed Optimizer
         #optimizer=Adam(lr=gen_lr, beta_1=adam_beta_1),
-        optimizer=hvd.DistributedOptimizer(Adam(lr=gen_lr, beta_1=adam_beta_1)),
+        optimizer=hvd.DistributedOptimizer(make_adam(gen_lr),
+                                           compression=hvd.Compression.fp16),
         loss=discriminator_losses
     )
 
     last_epoch_gen_loss = None
     last_epoch_disc_loss = None
 
-    def train_gan(epoch, nb_batches):
+    # preallocated float32 buffers for the generator pre-image, refilled in
+    # place every batch instead of allocating fresh float64 arrays
+    noise_buf = np.empty((batch_size, latent_size), dtype=np.float32)
+    energy_buf = np.empty((batch_size, 1), dtype=np.float32)
+    label_buf = np.empty(batch_size, dtype=np.int32)
+    flip_buf = np.empty(batch_size, dtype=np.int32)
+    flip_rand_buf = np.empty(batch_size, dtype=np.float32)
+
+    # the real batches are gathered into these, so the data itself never has
+    # to be shuffled (see train_gan)
+    real_data = [first, second, third, y, energy]
+    real_batch_bufs = [np.empty((batch_size, ) + X.shape[1:], dtype=X.dtype)
+                       for X in real_data]
+
+    # the float32 generated showers are cast into these before being fed to
+    # the (float16, under mixed precision) discriminator inputs
+    fake_batch_bufs = [np.empty((batch_size, ) + X.shape[1:], dtype=X.dtype)
+                       for X in real_data[:3]]
+
+    # constant {fake, real} targets and per-sample loss weights, built once
+    # and passed as-is to every train_on_batch call (Keras only reads them)
+    ones = np.ones(batch_size, dtype=np.float32)
+    zeros = np.zeros(batch_size, dtype=np.float32)
+
+    # downweight the energy reconstruction loss ($\lambda_E$ in paper)
+    loss_weights = [ones, 0.05 * ones]
+    if nb_classes > 1:
+        loss_weights.append(0.2 * ones)
+
+    def sample_noise():
+        return rng.standard_normal(dtype=np.float32, out=noise_buf)
+
+    def sample_energies():
+        # uniform in [1, 100) GeV
+        rng.random(dtype=np.float32, out=energy_buf)
+        # scale in place; an augmented assignment would rebind energy_buf
+        # as a local name of this function
+        np.multiply(energy_buf, 99, out=energy_buf)
+        np.add(energy_buf, 1, out=energy_buf)
+        return energy_buf
+
+    def sample_labels():
+        label_buf[:] = rng.integers(0, nb_classes, batch_size)
+        return label_buf
+
+    def train_gan(epoch, nb_batches, callbacks=()):
 
         if verbose:
             progress_bar = Progbar(target=nb_batches)
 
-        epoch_gen_loss = []
-        epoch_disc_loss = []
+        # running sums of the per-output losses, averaged at the end of the
+        # epoch instead of keeping a list of per-batch arrays
+        epoch_gen_loss = 0.
+        epoch_disc_loss = 0.
+        nb_gen_steps = 0
+
+        # a fresh shuffle of this rank's events every epoch, which also mixes
+        # the particle classes (they are read one file after the other)
+        order = np.random.default_rng([epoch, hvd.rank()]).permutation(
+            first.shape[0])
 
         for index in range(nb_batches):
             if verbose:
@@ -487,20 +811,25 @@ if __name__ == '__main__':
                 elif index % 10 == 0:
                     logger.debug('processed {}/{} batches'.format(index + 1, nb_batches))
 
+            for cb in callbacks:
+                cb.on_batch_begin(index)
+
             # generate a new batch of noise
-            noise = np.random.normal(0, 1, (batch_size, latent_size))
+            noise = sample_noise()
 
             # get a batch of real images
-            image_batch_1 = first[index * batch_size:(index + 1) * batch_size]
-            image_batch_2 = second[index * batch_size:(index + 1) * batch_size]
-            image_batch_3 = third[index * batch_size:(index + 1) * batch_size]
-            label_batch = y[index * batch_size:(index + 1) * batch_size]
-            energy_batch = energy[index * batch_size:(index + 1) * batch_size]
+            batch = order[index * batch_size:(index + 1) * batch_size]
+            # (the indices are always in range, 'clip' just avoids buffering)
+            image_batch_1, image_batch_2, image_batch_3, label_batch, \
+                energy_batch = [
+                    np.take(X, batch, axis=0, out=buf, mode='clip')
+                    for X, buf in zip(real_data, real_batch_bufs)
+                ]
 
             # energy_breakdown
 
-            sampled_labels = np.random.randint(0, nb_classes, batch_size)
-            sampled_energies = np.random.uniform(1, 100, (batch_size, 1))
+            sampled_labels = sample_labels()
+            sampled_energies = sample_energies()
 
             generator_inputs = [noise, sampled_energies]
             if nb_classes > 1:
@@ -508,19 +837,26 @@ if __name__ == '__main__':
                 # class to the pre-image of the generator
                 generator_inputs.append(sampled_labels)
 
-            generated_images = generator.predict(generator_inputs, verbose=0)
+            # a single batch, so skip predict()'s batching loop and progbar
+            generated_images = generator.predict_on_batch(generator_inputs)
+            if mixed_precision:
+                # an explicit cast into preallocated buffers, rather than one
+                # hidden in the feed; this is the cost of float16 storage
+                # on the fake path
+                for X, buf in zip(generated_images, fake_batch_bufs):
+                    np.copyto(buf, X, casting='same_kind')
+                generated_images = fake_batch_bufs
 
-            disc_outputs_real = [np.ones(batch_size), energy_batch]
-            disc_outputs_fake = [np.zeros(batch_size), sampled_energies]
+            disc_outputs_real = [ones, energy_batch]
+            disc_outputs_fake = [zeros, sampled_energies]
 
-            # downweight the energy reconstruction loss ($\lambda_E$ in paper)
-            loss_weights = [np.ones(batch_size), 0.05 * np.ones(batch_size)]
             if nb_classes > 1:
                 # in the case of the ACGAN, we need to append the realrequested
                 # class to the target
                 disc_outputs_real.append(label_batch)
-                disc_outputs_fake.append(bit_flip(sampled_labels, 0.3))
-                loss_weights.append(0.2 * np.ones(batch_size))
+                disc_outputs_fake.append(
+                    bit_flip(sampled_labels, 0.3, out=flip_buf,
+                             rand=flip_rand_buf))
 
             if (last_epoch_gen_loss is None) or (last_epoch_gen_loss < maintain_gen_loss_below) or (epoch < 10):
 
@@ -539,65 +875,87 @@ if __name__ == '__main__':
                   loss_weights
               )
 
-            epoch_disc_loss.append(
-                (np.array(fake_batch_loss) + np.array(real_batch_loss)) / 2)
+            epoch_disc_loss += np.add(fake_batch_loss, real_batch_loss)
 
             # we want to train the genrator to trick the discriminator
             # For the generator, we want all the {fake, real} labels to say
             # real
-            trick = np.ones(batch_size)
-
-            gen_losses = []
+            trick = ones
 
             # we do this twice simply to match the number of batches per epoch used to
-            # train the discriminator
+            # train the discriminator. Not as one step on a twice as large batch:
+            # the minibatch discrimination features depend on the batch size,
+            # and the discriminator is only ever trained on batch_size batches
             for _ in range(2*train_gen_per_epoch):
-                noise = np.random.normal(0, 1, (batch_size, latent_size))
+                noise = sample_noise()
 
-                sampled_energies = np.random.uniform(1, 100, (batch_size, 1))
+                sampled_energies = sample_energies()
                 combined_inputs = [noise, sampled_energies]
                 combined_outputs = [trick, sampled_energies]
                 if nb_classes > 1:
-                    sampled_labels = np.random.randint(0, nb_classes,
-                                                       batch_size)
+                    sampled_labels = sample_labels()
                     combined_inputs.append(sampled_labels)
                     combined_outputs.append(sampled_labels)
 
-                gen_losses.append(combined.train_on_batch(
+                epoch_gen_loss += np.asarray(combined.train_on_batch(
                     combined_inputs,
                     combined_outputs,
                     loss_weights
                 ))
+                nb_gen_steps += 1
 
-            epoch_gen_loss.append(np.mean(np.array(gen_losses), axis=0))
+        # each batch added both the real and the fake discriminator loss
+        epoch_disc_loss /= 2 * nb_batches
+        epoch_gen_loss /= nb_gen_steps
 
         logger.info('Epoch {:3d} Generator loss: {}'.format(
-            epoch + 1, np.mean(epoch_gen_loss, axis=0)))
+            epoch + 1, epoch_gen_loss))
         logger.info('Epoch {:3d} Discriminator loss: {}'.format(
-            epoch + 1, np.mean(epoch_disc_loss, axis=0)))
-        last_epoch_disc_loss = np.mean(epoch_disc_loss, axis=0)[0]
-        last_epoch_gen_lss = np.mean(epoch_gen_loss, axis=0)[0]
+            epoch + 1, epoch_disc_loss))
+        last_epoch_disc_loss = epoch_disc_loss[0]
+        last_epoch_gen_lss = epoch_gen_loss[0]
 
     last_epoch = -1
     rank_to_load = 0 if process0 else hvd.rank()
 
     # EV 07-Mar-2021: Load weights and optimizer states if load_model=True
 
-    def getLastEpoch(filenamemask):
-        files = glob.glob(filenamemask)
-        if len(files)==0:
-            return -1
-        latest_file = max(files, key=os.path.getctime)
-        newstr = ''.join((ch if ch in '0123456789' else ' ') for ch in latest_file)
-        listOfNumbers = [float(i) for i in newstr.split()]
-        last_epoch = int(listOfNumbers[0])
-        print("The last epoch was {}".format(last_epoch))
+    def getLastEpoch(prefix, ext, rank=None):
+        """ returns the highest epoch among '<prefix><epoch>_<rank>.<ext>'
+        files (any rank if rank is None), or -1 if there are none """
+        dirname, basename = os.path.split(prefix)
+        pattern = re.compile(r'{0}(\d{{4,}})_{1}\.{2}$'.format(
+            re.escape(basename),
+            r'\d{3,}' if rank is None else '{0:03d}'.format(rank),
+            re.escape(ext)
+        ))
+        last_epoch = -1
+        # match on the entry names only: no glob, no stat() per file
+        for entry in os.scandir(dirname or '.'):
+            m = pattern.match(entry.name)
+            if m:
+                last_epoch = max(last_epoch, int(m.group(1)))
+        if last_epoch > -1:
+            print("The last epoch was {}".format(last_epoch))
         return last_epoch
 
 
+    def delete_checkpoints(ext):
+        """ waits until every rank is done reading, then removes the *.ext
+        files, once per node in case the working directory is node-local """
+        hvd.allreduce(np.array(1.0), name='{}_loaded_barrier'.format(ext))
+        if hvd.local_rank()==0:
+            for filename in glob.glob('*.{}'.format(ext)):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    # another node sharing the directory removed it first
+                    pass
+
+
     if load_model:
         # Get latest epoch for saved optimizer state data
-        last_epoch = getLastEpoch('{0}*_{1:03d}.optimizer'.format(parse_args.c_pfx,rank_to_load))
+        last_epoch = getLastEpoch(parse_args.c_pfx, 'optimizer', rank_to_load)
         print("Latest epoch in optimizer state data: {}".format(last_epoch))
 
 
@@ -611,7 +969,8 @@ if __name__ == '__main__':
         if len(files)==0:
             raise Exception("Generator optimizer state file {} not found".format(filename))
         print("Using generator optimizer state from {}".format(filename))
-        opt_weights = np.load(filename, allow_pickle=True)
+        opt_weights = _load_optimizer_weights(
+            filename, [K.int_shape(w) for w in generator.optimizer.weights])
         generator.optimizer.set_weights(opt_weights)
         
         # Load discriminator optimizer state
@@ -620,7 +979,8 @@ if __name__ == '__main__':
         if len(files)==0:
             raise Exception("Discriminator optimizer state file {} not found".format(filename))
         print("Using discriminator optimizer state from {}".format(filename))
-        opt_weights = np.load(filename, allow_pickle=True)
+        opt_weights = _load_optimizer_weights(
+            filename, [K.int_shape(w) for w in discriminator.optimizer.weights])
         discriminator.optimizer.set_weights(opt_weights)
 
         # Load combined optimizer state
@@ -629,22 +989,21 @@ if __name__ == '__main__':
         if len(files)==0:
             raise Exception("Combined optimizer state file {} not found".format(filename))
         print("Using combined optimizer state from {}".format(filename))
-        opt_weights = np.load(filename, allow_pickle=True)
+        opt_weights = _load_optimizer_weights(
+            filename, [K.int_shape(w) for w in combined.optimizer.weights])
         combined.optimizer.set_weights(opt_weights)
         if not no_delete:
-            print("Sleeping 120 seconds...")
-            time.sleep(120)
-            os.system("rm -rf *.optimizer")
+            delete_checkpoints('optimizer')
 
 
     if load_weights and not(load_model):
-        last_epoch = getLastEpoch('{0}*_{1:03d}.weights'.format(parse_args.d_pfx,rank_to_load))
+        last_epoch = getLastEpoch(parse_args.d_pfx, 'weights', rank_to_load)
         print("Latest epoch in weights data: {}".format(last_epoch))
 
 
     if (load_weights or load_model) and (last_epoch>-1):
         if not load_model:
-            last_epoch = getLastEpoch('{0}*.weights'.format(parse_args.d_pfx))
+            last_epoch = getLastEpoch(parse_args.d_pfx, 'weights')
             print("Latest epoch in weights data: {}".format(last_epoch))
         
         # Load generator weights
@@ -665,53 +1024,50 @@ if __name__ == '__main__':
         print("Using discriminator weights from {}".format(filename))
         discriminator.load_weights(filename)
 
-        if weights_averaging_coeff!=0.0:
-            this_generator_weights = generator.get_weights()
-            all_generator_weights = []
-            for rank in range(0,hvd.size()):
-                filename = '{0}{1:04d}_{2:03d}.weights'.format(parse_args.g_pfx,last_epoch,rank)
-                files = glob.glob(filename)
-                if len(files)==0:
-                    raise Exception("Generator weights file {} not found".format(filename))
-                generator.load_weights(filename)
-                all_generator_weights.append(generator.get_weights())
-            new_weights = list()
-            for weights_list_tuple in zip(*all_generator_weights):
-                new_weights.append([np.array(weights_).mean(axis=0) for weights_ in zip(*weights_list_tuple)])
-            weights_to_load = list()
-            for weights_list_tuple in zip(*[new_weights, this_generator_weights]):
-                weights_to_load.append([weights_averaging_coeff*np.array(weights_[0])+(1.0-weights_averaging_coeff)*np.array(weights_[1]) for weights_ in zip(*weights_list_tuple)])
-            generator.set_weights(weights_to_load)
-
-            this_discriminator_weights = discriminator.get_weights()
-            all_discriminator_weights = []
+        def _averaged_weights(model, pfx, name):
+            """ blends this rank's weights with their mean over all ranks,
+            accumulated one rank at a time straight from the HDF5 files """
+            this_weights = model.get_weights()
+            acc = [np.zeros_like(w) for w in this_weights]
             for rank in range(0,hvd.size()):
-                filename = '{0}{1:04d}_{2:03d}.weights'.format(parse_args.d_pfx,last_epoch,rank)
+                filename = '{0}{1:04d}_{2:03d}.weights'.format(pfx,last_epoch,rank)
                 files = glob.glob(filename)
                 if len(files)==0:
-                    raise Exception("Generator weights file {} not found".format(filename))
-                discriminator.load_weights(filename)
-                all_discriminator_weights.append(discriminator.get_weights())
-            new_weights = list()
-            for weights_list_tuple in zip(*all_discriminator_weights):
-                new_weights.append([np.array(weights_).mean(axis=0) for weights_ in zip(*weights_list_tuple)])
-            weights_to_load = list()
-            for weights_list_tuple in zip(*[new_weights, this_discriminator_weights]):
-                weights_to_load.append([weights_averaging_coeff*np.array(weights_[0])+(1.0-weights_averaging_coeff)*np.array(weights_[1]) for weights_ in zip(*weights_list_tuple)])
-            discriminator.set_weights(weights_to_load)
+                    raise Exception("{} weights file {} not found".format(name, filename))
+                rank_weights = _read_keras_hdf5_weights(filename)
+                if len(rank_weights) != len(acc):
+                    raise Exception("{} weights file {} does not match the model".format(name, filename))
+                for i, w in enumerate(rank_weights):
+                    np.add(acc[i], w, out=acc[i])
+            for a in acc:
+                a *= 1.0/hvd.size()
+            return [weights_averaging_coeff*a+(1.0-weights_averaging_coeff)*t
+                    for a, t in zip(acc, this_weights)]
+
+        if weights_averaging_coeff!=0.0:
+            generator.set_weights(
+                _averaged_weights(generator, parse_args.g_pfx, "Generator"))
+            discriminator.set_weights(
+                _averaged_weights(discriminator, parse_args.d_pfx, "Discriminator"))
 
         if not no_delete:
-            print("Sleeping 120 seconds...")
-            time.sleep(120)
-            os.system("rm -rf *.weights")
+            delete_checkpoints('weights')
+
 
+    # batches per epoch on each rank, the same on all of them (see _load_data)
+    nb_batches = int(first.shape[0] / batch_size)
 
     # EV 10-Jan-2021: Broadcast initial variable states from rank 0 to all other processes
     # EV 06-Fev-2021: add hvd.callbacks.MetricAverageCallback()
+    # warm up the hvd.size()-scaled learning rates of the two trained optimizers
     
     gcb = CallbackList([hvd.callbacks.BroadcastGlobalVariablesCallback(0), hvd.callbacks.MetricAverageCallback()])
-    dcb = CallbackList([hvd.callbacks.BroadcastGlobalVariablesCallback(0), hvd.callbacks.MetricAverageCallback()])
-    ccb = CallbackList([hvd.callbacks.BroadcastGlobalVariablesCallback(0), hvd.callbacks.MetricAverageCallback()])
+    dcb = CallbackList([hvd.callbacks.BroadcastGlobalVariablesCallback(0), hvd.callbacks.MetricAverageCallback(),
+                        hvd.callbacks.LearningRateWarmupCallback(initial_lr=disc_lr, warmup_epochs=3,
+                                                                 steps_per_epoch=nb_batches)])
+    ccb = CallbackList([hvd.callbacks.BroadcastGlobalVariablesCallback(0), hvd.callbacks.MetricAverageCallback(),
+                        hvd.callbacks.LearningRateWarmupCallback(initial_lr=gen_lr, warmup_epochs=3,
+                                                                 steps_per_epoch=nb_batches)])
 
     gcb.set_model( generator )
     dcb.set_model( discriminator )
@@ -727,9 +1083,11 @@ if __name__ == '__main__':
     for epoch in range(last_epoch+1, nb_epochs+last_epoch+1):
 
         logger.info('Epoch {} of {}'.format(epoch + 1, nb_epochs+last_epoch+1))
-        nb_batches = int(first.shape[0] / batch_size)
-        
-        train_gan(epoch, nb_batches)
+
+        dcb.on_epoch_begin(epoch)
+        ccb.on_epoch_begin(epoch)
+
+        train_gan(epoch, nb_batches, callbacks=(dcb, ccb))
 
         # save weights every epoch
         # EV 10-Jan-2021: this needs to done only on one process. Otherwise each worker is writing it.
@@ -747,11 +1105,14 @@ if __name__ == '__main__':
                 #combined.save('combined{0:04d}.model'.format(epoch),
                 #               overwrite=True)
                 # Save optimizer state for generator model
-                with open('{0}{1:04d}_{2:03d}.optimizer'.format(parse_args.g_pfx, epoch, hvd.rank()), 'wb') as f:
-                    np.save(f, generator.optimizer.get_weights())
+                _save_optimizer_weights(
+                    '{0}{1:04d}_{2:03d}.optimizer'.format(parse_args.g_pfx, epoch, hvd.rank()),
+                    generator.optimizer.get_weights())
                 # Save optimizer state for discriminator model
-                with open('{0}{1:04d}_{2:03d}.optimizer'.format(parse_args.d_pfx, epoch, hvd.rank()), 'wb') as f:
-                    np.save(f, discriminator.optimizer.get_weights())
+                _save_optimizer_weights(
+                    '{0}{1:04d}_{2:03d}.optimizer'.format(parse_args.d_pfx, epoch, hvd.rank()),
+                    discriminator.optimizer.get_weights())
                 # Save optimizer state for the combined model
-                with open('{0}{1:04d}_{2:03d}.optimizer'.format(parse_args.c_pfx, epoch, hvd.rank()), 'wb') as f:
-                    np.save(f, combined.optimizer.get_weights())
+                _save_optimizer_weights(
+                    '{0}{1:04d}_{2:03d}.optimizer'.format(parse_args.c_pfx, epoch, hvd.rank()),
+                    combined.optimizer.get_weights())